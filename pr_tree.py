@@ -1,139 +1,210 @@
 #!/usr/bin/env python3
 #
 import os
-from concurrent.futures.thread import ThreadPoolExecutor
+import re
+import sys
+from collections import defaultdict, deque
 from dataclasses import dataclass, field
+from functools import lru_cache
 from time import sleep
-from typing import Iterator, List, Optional, Tuple, Iterable, Dict
+from typing import Iterator, List, Optional, Tuple, Dict
 
 import plumbum.colors as colors
-from github import Repository, PullRequest, Issue, PullRequestReview
-from github.AuthenticatedUser import AuthenticatedUser
+from github import Repository
+from github.GithubRetry import GithubRetry
 from github.MainClass import Github
 from plumbum import cli, local, FG, ProcessExecutionError
 from plumbum.cli import switch
+from urllib3 import Retry
 
 GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
 if not GITHUB_TOKEN:
     raise Exception("GitHub token not specified in environment. Please set GITHUB_TOKEN")
-github: Github = Github(GITHUB_TOKEN)
+# PyGithub throttles its requests and retries rate limited GETs and POSTs (honouring Retry-After),
+# the PATCHes updating PR bodies are just as safe to retry
+github: Github = Github(GITHUB_TOKEN,
+                        retry=GithubRetry(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"GET", "POST", "PATCH"}))
 
 git = local["git"]
 bash = local["bash"]
 
+# e.g. git@github.com:owner/name.git, ssh://git@github.com/owner/name.git or https://github.com/owner/name
+GITHUB_REMOTE_URL = re.compile(r"^(?:git@github\.com:|(?:ssh|https)://(?:[^@/]+@)?github\.com/)"
+                               r"([^/]+)/([^/]+?)(?:\.git)?/?$")
+
+# (is root, is last sibling, has children) -> what's drawn between a node's ancestor columns and its name
+TREE_GLYPHS = {
+    (True, True, False): "── ",
+    (True, True, True): "─┬ ",
+    (True, False, False): "── ",
+    (True, False, True): "─┬ ",
+    (False, True, False): "└─ ",
+    (False, True, True): "└┬ ",
+    (False, False, False): "├─ ",
+    (False, False, True): "├┬ ",
+}
+
+REVIEW_STATE_EMOJIS = {
+    "APPROVED": "✅",
+    "CHANGES_REQUESTED": "❌",
+    "COMMENTED": "💬",
+    "PENDING": "⏳",
+}
+
 verbose = colors.dim
 branch_color = colors.green
 sha_color = colors.yellow
 
 
-class RemoteRepo:
-    def __init__(self, repo: Repository):
-        self._repo = repo
+USER_PRS_QUERY = """
+query($search: String!, $after: String) {
+  search(type: ISSUE, query: $search, first: 100, after: $after) {
+    pageInfo { hasNextPage endCursor }
+    nodes {
+      ... on PullRequest {
+        number
+        state
+        title
+        body
+        headRefName
+        headRefOid
+        baseRefName
+        baseRefOid
+        author { login }
+        latestReviews(first: 50) {
+          nodes { author { login } state }
+        }
+        reviewRequests(first: 50) {
+          nodes { requestedReviewer { ... on User { login } } }
+        }
+      }
+    }
+  }
+}
+"""
 
-    def get_user_prs(self, user: AuthenticatedUser) -> List['PrInfo']:
-        issues: Iterable[Issue] = github.search_issues(
-            "", type="pr", author=user.login, repo=self._repo.full_name, **{'is': 'open'})
-        pr_numbers: List[int] = [issue.number for issue in issues]
 
-        with ThreadPoolExecutor() as executor:
-            prs: List[PullRequest] = executor.map(self._repo.get_pull, pr_numbers)
+class RemoteRepo:
+    __slots__ = ('_owner', '_name', '_repo')
 
-        return [PrInfo(self, pr) for pr in prs]
+    def __init__(self, owner: str, name: str):
+        self._owner = owner
+        self._name = name
+        self._repo: Repository = github.get_repo("%s/%s" % (owner, name), lazy=True)
+
+    def get_user_prs(self) -> List['PrInfo']:
+        """
+        fetches all the open PRs of the authenticated user in a single paginated GraphQL search, instead of a search
+        followed by a GET per PR. The search filters by author on the server, so other users' PRs are never fetched.
+        :return:
+        """
+        search = "repo:%s/%s is:pr is:open author:@me" % (self.get_owner(), self.get_name())
+        prs: List[PrInfo] = []
+        cursor: Optional[str] = None
+        while True:
+            data = self._graphql(USER_PRS_QUERY, {"search": search, "after": cursor})
+            results = data["search"]
+            prs.extend(PrInfo(self, pr_data) for pr_data in results["nodes"])
+            if not results["pageInfo"]["hasNextPage"]:
+                return prs
+            cursor = results["pageInfo"]["endCursor"]
+
+    def update_pr_body(self, number: int, body: str):
+        # patch the PR directly, PyGithub's get_pull(number).edit(...) would first GET the whole PR
+        # noinspection PyProtectedMember
+        self._repo._requester.requestJsonAndCheck("PATCH", "%s/pulls/%d" % (self._repo.url, number),
+                                                  input={"body": body})
 
     def get_owner(self) -> str:
-        return self._repo.owner.name
+        return self._owner
 
     def get_name(self) -> str:
-        return self._repo.name
+        return self._name
+
+    def _graphql(self, query: str, variables: Dict) -> Dict:
+        # noinspection PyProtectedMember
+        requester = self._repo._requester
+        _, result = requester.requestJsonAndCheck("POST", requester.graphql_url,
+                                                  input={"query": query, "variables": variables})
+        if "errors" in result:
+            raise Exception("GraphQL query failed: %s" % result["errors"])
+        return result["data"]
 
 
-@dataclass
+@dataclass(slots=True)
 class ReviewerState:
     reviewer: str
     state: str
 
     def to_emoji(self) -> str:
-        if self.state == "APPROVED":
-            return "✅"
-        elif self.state == "CHANGES_REQUESTED":
-            return "❌"
-        elif self.state == "COMMENTED":
-            return "💬"
-        elif self.state == "PENDING":
-            return "⏳"
-        else:
-            return self.state
+        return REVIEW_STATE_EMOJIS.get(self.state, self.state)
 
 
 class PrInfo:
-    def __init__(self, repo: RemoteRepo, pr: PullRequest):
+    __slots__ = ('_repo', '_data')
+
+    def __init__(self, repo: RemoteRepo, data: Dict):
         self._repo = repo
-        self._pr = pr
+        self._data = data
 
     def is_open(self) -> bool:
-        return self._pr.state == "open"
+        return self._data["state"] == "OPEN"
 
     def pr_number(self) -> int:
-        return self._pr.number
+        return self._data["number"]
 
     def head_branch_name(self) -> str:
-        return self._pr.head.ref
+        return self._data["headRefName"]
 
     def head_sha(self) -> str:
-        return self._pr.head.sha
+        return self._data["headRefOid"]
 
     def base_branch_name(self) -> str:
-        return self._pr.base.ref
+        return self._data["baseRefName"]
 
     def base_sha(self) -> str:
-        return self._pr.base.sha
-
-    def pr_data(self) -> Dict:
-        """
-        library doesn't support some of the attributes, need to get the data ourselves
-        :return:
-        """
-        if hasattr(self, '_pr_data'):
-            return self._pr_data
-        # noinspection PyProtectedMember
-        _, pr_data = self._pr._requester.requestJsonAndCheck("GET", self._pr.url)
-        setattr(self, '_pr_data', pr_data)
-        return pr_data
+        return self._data["baseRefOid"]
 
-    def reviewer_states(self, user: AuthenticatedUser) -> List[ReviewerState]:
-        reviews: List[PullRequestReview] = list(self._pr.get_reviews())
+    def reviewer_states(self) -> List[ReviewerState]:
+        if not self.is_open():  # reviews of closed PRs aren't shown
+            return []
         reviewer_states = {}
 
-        for review in reviews:
-            if review.user.login == user.login:  # skip reviews from author
+        for review in self._data["latestReviews"]["nodes"]:
+            if not review["author"] or review["author"] == self._data["author"]:  # skip reviews from author
                 continue
-            reviewer_states[review.user.login] = ReviewerState(reviewer=review.user.login, state=review.state)
+            login = review["author"]["login"]
+            reviewer_states[login] = ReviewerState(reviewer=login, state=review["state"])
 
-        for requested_reviewer in self.pr_data()["requested_reviewers"]:
+        for review_request in self._data["reviewRequests"]["nodes"]:
+            requested_reviewer = review_request["requestedReviewer"]
+            if not requested_reviewer or "login" not in requested_reviewer:  # skip team review requests
+                continue
             login = requested_reviewer["login"]
             reviewer_states[login] = ReviewerState(reviewer=login, state="PENDING")
 
         return list(reviewer_states.values())
 
     def title(self):
-        return self._pr.title
+        return self._data["title"]
 
     def body(self):
-        return self._pr.body
+        return self._data["body"]
 
     def update_body(self, new_body: str):
-        self._pr.edit(body=new_body)
+        self._repo.update_pr_body(self.pr_number(), new_body)
 
     def get_link(self):
         return "https://github.com/%s/%s/pull/%d" % (self._repo.get_owner(), self._repo.get_name(), self.pr_number())
 
 
-@dataclass
+@dataclass(slots=True, eq=False)  # nodes are compared by identity
 class TreeNode:
     base_node: Optional['TreeNode']
     head_branch: str
     pr_info: Optional[PrInfo]
     children: List['TreeNode'] = field(default_factory=list)
+    index_in_parent: int = 0
 
     def is_root(self) -> bool:
         if not self.base_node:
@@ -150,17 +221,16 @@ class TreeNode:
     def is_last_sibling(self) -> bool:
         if not self.base_node:
             return True
-        index = self.base_node.children.index(self)
-        sibling_count = len(self.base_node.children)
-        return index == (sibling_count - 1)
+        return self.index_in_parent == len(self.base_node.children) - 1
 
 
-@dataclass
+@dataclass(slots=True)
 class LocalCommit:
     sha: str
+    message: str
 
     def get_message(self) -> str:
-        return git("log", "--format=%B", "-n", 1, self.sha).strip()
+        return self.message
 
 
 class PrTree(cli.Application):
@@ -174,7 +244,6 @@ class UpdateDependencies(cli.Application):
     """
     Updates all the dependent PRs of a PR by recursively rebasing them
     """
-    __user: AuthenticatedUser
     __repo: RemoteRepo
     __root: str
     __dry_run = \
@@ -188,6 +257,9 @@ class UpdateDependencies(cli.Application):
                  help="Whether or not to delete the root branch while rebasing. "
                       "Deleting results in the children rebasing onto the root's parent and not itself. "
                       "Deleting has no effect if the branch is the root branch (i.e. master). ")
+    __interactive = \
+        cli.Flag("--interactive",
+                 help="Open the todo list of each rebase in an editor (i.e. `git rebase -i`)")
 
     @switch("--root", str, mandatory=True)
     def root(self, value: str):
@@ -197,33 +269,25 @@ class UpdateDependencies(cli.Application):
         self.__root = value
 
     def main(self):
-        self.__user = github.get_user()
-
-        self.__repo = get_repo(self.__user)
+        self.__repo = get_repo()
 
         print(verbose | "fetching PRs")
-        prs = list(self.__repo.get_user_prs(self.__user))
-        roots = create_tree(prs)
+        prs = list(self.__repo.get_user_prs())
+        roots = create_tree(prs, root_filter=self.__root)
         roots = trim_closed_prs(roots)
 
-        @dataclass()
+        @dataclass(slots=True)
         class RebaseStep:
             base: TreeNode
             base_initial_local_sha: str
             child: TreeNode
 
         rebase_steps: List[RebaseStep] = []
-        root_node: Optional[TreeNode] = None
+        root_node = _find_node(roots, self.__root)
         dependencies: List[TreeNode] = []
-        for node, ancestry in _depth_first(roots):
-            if node.head_branch == self.__root:
-                root_node = node
-            if not node.base_node:  # can't rebase root
-                continue
-
+        # only the branches based (directly or not) on the root are rebased
+        for node, _ in _depth_first(root_node.children if root_node else []):
             base = node.base_node
-            if self.__root not in set(a.head_branch for a in ancestry):  # skip trees not including the root node
-                continue
             if self.__delete and base.head_branch == self.__root and base.base_node:
                 dependencies.append(node)
                 base = base.base_node
@@ -256,7 +320,7 @@ class UpdateDependencies(cli.Application):
             sleep(10)
             try:
                 git[  #
-                    "rebase", "-i", "--onto",
+                    "rebase", *(["-i"] if self.__interactive else []), "--onto",
                     step.base.head_branch,
                     step.base_initial_local_sha,
                     step.child.head_branch] & FG
@@ -271,6 +335,7 @@ class UpdateDependencies(cli.Application):
                     bash & FG
                 except ProcessExecutionError:
                     pass
+            clear_branch_caches()  # the rebase moved the branch
 
             print()
 
@@ -285,7 +350,6 @@ class ForcePush(cli.Application):
     """
     Updates all the dependent PRs of a PR by recursively rebasing them
     """
-    __user: AuthenticatedUser
     __repo: RemoteRepo
     __root: str
     __dry_run = \
@@ -300,8 +364,7 @@ class ForcePush(cli.Application):
         self.__root = value
 
     def main(self):
-        self.__user = github.get_user()
-        self.__repo = get_repo(self.__user)
+        self.__repo = get_repo()
 
         remotes = get_remotes()
         if len(remotes) != 1:
@@ -310,20 +373,20 @@ class ForcePush(cli.Application):
         remote = remotes[0]
 
         print(verbose | "fetching PRs")
-        prs = list(self.__repo.get_user_prs(self.__user))
-        roots = create_tree(prs)
+        prs = list(self.__repo.get_user_prs())
+        roots = create_tree(prs, root_filter=self.__root)
         roots = trim_closed_prs(roots)
 
-        @dataclass
+        @dataclass(slots=True)
         class PushStep:
             branch_name: str
             local_sha: str
             remote_sha: str
 
         steps: List[PushStep] = []
-        for node, ancestry in _depth_first(roots):
-            if self.__root not in set(a.head_branch for a in ancestry):  # skip nodes not including the selected root
-                continue
+        root_node = _find_node(roots, self.__root)
+        # only the branches based (directly or not) on the selected root are pushed
+        for node, _ in _depth_first(root_node.children if root_node else []):
             if not node.pr_info:  # branches (e.g. master) that don't have PRs created
                 continue
             step = PushStep(
@@ -356,50 +419,30 @@ class PrintPrs(cli.Application):
     """
     Prints the user's PRs in the form of a tree, where each node is placed below it's base branch
     """
-    __user: AuthenticatedUser
     __repo: RemoteRepo
 
     def main(self):
-        self.__user = github.get_user()
-
-        self.__repo = get_repo(self.__user)
+        self.__repo = get_repo()
 
         print(verbose | "fetching PRs")
-        prs = list(self.__repo.get_user_prs(self.__user))
+        prs = list(self.__repo.get_user_prs())
         roots = create_tree(prs)
         roots = trim_closed_prs(roots)
 
-        print(verbose | "fetching reviews")
-
-        def get_pr_reviewers(pr: PrInfo):
-            return pr.pr_number(), pr.reviewer_states(self.__user)
+        # rendered once per PR, rather than once per node while printing the tree
+        reviewer_display = {pr.pr_number(): ",".join("%s:%s" % (rev_state.reviewer, rev_state.to_emoji())
+                                                     for rev_state in pr.reviewer_states())
+                            for pr in prs if pr.is_open()}
+        self.__print(roots, reviewer_display)
 
-        open_prs = [pr for pr in prs if pr.is_open()]
-        with ThreadPoolExecutor() as executor:
-            reviewer_states = {k: v for k, v in executor.map(get_pr_reviewers, open_prs)}
-        self.__print(roots, reviewer_states)
+    def __print(self, roots: List[TreeNode], reviewer_display: Dict[int, str]):
+        lines = []
+        # same as `branch_color | name`, without building a style object per node
+        branch_start, branch_end = str(branch_color), str(~branch_color)
+        for node, prefix in _depth_first_with_prefix(roots):
+            line_segments = [prefix, TREE_GLYPHS[(node.is_root(), node.is_last_sibling(), node.has_children())]]
 
-    def __print(self, roots: List[TreeNode], reviewer_states: Dict[int, List[ReviewerState]]):
-        for node, parentage in _depth_first(roots):
-            line_segments = []
-            for p in parentage:
-                if p.is_last_sibling():
-                    line_segments.append(" ")
-                else:
-                    line_segments.append("│")
-            if node.is_root():
-                line_segments.append("─")
-            elif node.is_last_sibling():
-                line_segments.append("└")
-            else:
-                line_segments.append("├")
-
-            if node.has_children():
-                line_segments.append("┬ ")
-            else:
-                line_segments.append("─ ")
-
-            line_segments.append(branch_color | node.head_branch)
+            line_segments.append(branch_start + node.head_branch + branch_end)
             if node.pr_info:
                 base_branch = node.pr_info.base_branch_name()
                 head_branch = node.head_branch
@@ -421,12 +464,13 @@ class PrintPrs(cli.Application):
                 line_segments.append(" [%d]" % node.pr_info.pr_number())
                 line_segments.append(" ")
                 if node.pr_info.is_open():
-                    line_segments.append(",".join("%s:%s" % (rev_state.reviewer, rev_state.to_emoji())
-                                                  for rev_state in reviewer_states[node.pr_info.pr_number()]))
+                    line_segments.append(reviewer_display[node.pr_info.pr_number()])
                 else:
                     line_segments.append("closed")
 
-            print("".join(line_segments))
+            lines.append("".join(line_segments))
+
+        sys.stdout.write("".join(line + "\n" for line in lines))  # a single write for the whole tree
 
 
 @PrTree.subcommand("update-bodies")
@@ -434,7 +478,6 @@ class UpdateBodies(cli.Application):
     """
     Updates all the bodies of PRs in a PR-tree, with the current structure of the PR
     """
-    __user: AuthenticatedUser
     __repo: RemoteRepo
     __root: str
     __dry_run = \
@@ -449,43 +492,26 @@ class UpdateBodies(cli.Application):
         self.__root = value
 
     def main(self):
-        self.__user = github.get_user()
-
-        self.__repo = get_repo(self.__user)
+        self.__repo = get_repo()
 
         print(verbose | "fetching PRs")
-        prs = list(self.__repo.get_user_prs(self.__user))
-        roots = create_tree(prs)
+        prs = list(self.__repo.get_user_prs())
+        roots = create_tree(prs, root_filter=self.__root)
         roots = trim_closed_prs(roots)
         roots = [r for r in roots if r.head_branch == self.__root]
 
         start_token = '```console\r\nPR Tree:\r\n'
         end_token = '```'
 
-        def print_tree_desc(base: TreeNode, selected_node: TreeNode):
-            tree_desc: str = ''
-            for n, parentage in _depth_first([base]):
-                line_segments = []
-                for p in parentage:
-                    if p.is_last_sibling():
-                        line_segments.append(" ")
-                    else:
-                        line_segments.append("│")
-                if n == base:
-                    line_segments.append("─")
-                elif n.is_last_sibling():
-                    line_segments.append("└")
-                else:
-                    line_segments.append("├")
+        def tree_desc_lines(base: TreeNode) -> List[Tuple[TreeNode, str]]:
+            lines = []
+            for n, prefix in _depth_first_with_prefix([base]):
+                padding = prefix + TREE_GLYPHS[(n == base, n.is_last_sibling(), n.has_children())]
+                lines.append((n, f'{padding}{n.pr_info.title()} [{n.pr_info.pr_number()}]'))
+            return lines
 
-                if n.has_children():
-                    line_segments.append("┬ ")
-                else:
-                    line_segments.append("─ ")
-                padding = ''.join(line_segments)
-                is_here = ' <- this PR' if n == selected_node else ''
-                tree_desc += f'{padding}{n.pr_info.title()} [{n.pr_info.pr_number()}]{is_here}\n'
-            return tree_desc
+        def print_tree_desc(lines: List[Tuple[TreeNode, str]], selected_node: TreeNode) -> str:
+            return ''.join(line + (' <- this PR' if n is selected_node else '') + '\n' for n, line in lines)
 
         def add_tree_desc(current_body: str, tree_desc: str, is_tree: bool) -> str | None:
             if not is_tree:  # don't add to PRs that are not part of a tree
@@ -505,8 +531,9 @@ class UpdateBodies(cli.Application):
         for root in roots:
             for base_pr in root.children:
                 is_tree = len(base_pr.children) > 0
-                for node, _ in _depth_first([base_pr]):
-                    tree_desc = print_tree_desc(base_pr, node)
+                lines = tree_desc_lines(base_pr)  # only the "<- this PR" marker differs between the PRs
+                for node, _ in lines:
+                    tree_desc = print_tree_desc(lines, node)
                     new_body = update_tree_desc(node.pr_info.body(), tree_desc, is_tree)
                     print('For', branch_color | node.head_branch)
                     if new_body:
@@ -521,60 +548,74 @@ class UpdateBodies(cli.Application):
                     print()
 
 
-def get_repo(user: AuthenticatedUser) -> RemoteRepo:
+def get_repo() -> RemoteRepo:
     origin: str = git("config", "--get", "remote.origin.url")
     origin = origin.strip()
-    for org in user.get_orgs():
-        for repo in org.get_repos():
-            repo: Repository
-            print(f'found repo: {repo}')
-            if repo.ssh_url == origin or repo.html_url == origin:
-                return RemoteRepo(repo)
-    raise Exception("Unable to find repo for %s in your GitHub account" % origin)
+    match = GITHUB_REMOTE_URL.match(origin)
+    if not match:
+        raise Exception("Unable to find a GitHub repo in remote %s" % origin)
+    return RemoteRepo(owner=match.group(1), name=match.group(2))
 
 
-def create_tree(prs: List[PrInfo]) -> List[TreeNode]:
+def create_tree(prs: List[PrInfo], *, root_filter: Optional[str] = None) -> List[TreeNode]:
+    """
+    :param root_filter: only build the tree containing this branch
+    :return:
+    """
     head_to_base = {}
     head_to_pr = {}
     for pr in prs:
         head_to_base[pr.head_branch_name()] = pr.base_branch_name()
         head_to_pr[pr.head_branch_name()] = pr
 
-    def get_pr(branch: str) -> Optional[PrInfo]:
-        return head_to_pr[branch] if branch in head_to_pr else None
-
-    leafs = {
-        b: TreeNode(base_node=None,
-                    head_branch=b,
-                    pr_info=get_pr(b))
-        for _, b in head_to_base.items()
-        if b not in head_to_base
-    }
-    roots = [v for k, v in leafs.items()]
-
-    while leafs:
-        leaf_branches = {l for l in leafs.keys()}
-        next_leafs = {}
-        for l in leaf_branches:
-            for h, b in head_to_base.items():
-                if b == l:
-                    new_node = TreeNode(base_node=leafs[l],
-                                        head_branch=h,
-                                        pr_info=get_pr(h))
-                    next_leafs[h] = new_node
-                    leafs[l].children.append(new_node)
-
-        leafs = next_leafs
+    base_to_heads: Dict[str, List[str]] = defaultdict(list)
+    for h, b in head_to_base.items():
+        base_to_heads[b].append(h)
+    for heads in base_to_heads.values():
+        heads.sort()  # children are created in branch order, so the traversal is the same on every run
+
+    if root_filter is None:
+        root_branches = {b for b in head_to_base.values() if b not in head_to_base}
+    else:  # follow the bases down to the filter's root, the other trees never get built
+        root_branch = root_filter
+        visited = {root_branch}
+        while root_branch in head_to_base and head_to_base[root_branch] not in visited:
+            root_branch = head_to_base[root_branch]
+            visited.add(root_branch)
+        is_root = root_branch not in head_to_base and root_branch in base_to_heads
+        root_branches = {root_branch} if is_root else set()
+
+    roots = [TreeNode(base_node=None,
+                      head_branch=b,
+                      pr_info=head_to_pr.get(b))
+             for b in sorted(root_branches)]
+
+    queue = deque(roots)
+    while queue:
+        node = queue.popleft()
+        for h in base_to_heads.get(node.head_branch, ()):
+            child = TreeNode(base_node=node,
+                             head_branch=h,
+                             pr_info=head_to_pr.get(h),
+                             index_in_parent=len(node.children))
+            node.children.append(child)
+            queue.append(child)
 
     return roots
 
 
 def trim_closed_prs(roots: List[TreeNode]) -> List[TreeNode]:
-    new_roots = []
-    for node, parents in reversed(list(_depth_first(roots))):
+    # post-order walk, a node can only be trimmed once its children have been
+    stack: List[Tuple[TreeNode, bool]] = [(r, False) for r in reversed(roots)]
+    while stack:
+        node, children_visited = stack.pop()
+        if not children_visited:
+            stack.append((node, True))
+            stack.extend((c, False) for c in node.children)
+            continue
+
         base = node.base_node
         if base is None:  # don't trim roots
-            new_roots.append(node)
             continue
 
         if node.pr_info and node.pr_info.is_open():  # don't trim open prs
@@ -583,32 +624,70 @@ def trim_closed_prs(roots: List[TreeNode]) -> List[TreeNode]:
             continue
 
         base.children.remove(node)
+        for i, sibling in enumerate(base.children):
+            sibling.index_in_parent = i
         node.base_node = None
 
-    return new_roots
+    return roots
 
 
-def _depth_first(nodes: List[TreeNode]) -> Iterator[Tuple[TreeNode, List[TreeNode]]]:
-    def transverse(node: TreeNode, chain: List[TreeNode]) -> Iterator[Tuple[TreeNode, List[TreeNode]]]:
-        yield (node, chain)
-        for m in node.children:
-            yield from transverse(m, chain + [node])
+def _find_node(roots: List[TreeNode], head_branch: str) -> Optional[TreeNode]:
+    return next((node for node, _ in _depth_first(roots) if node.head_branch == head_branch), None)
 
-    for n in nodes:
-        yield from transverse(n, [])
+
+def _depth_first(nodes: List[TreeNode]) -> Iterator[Tuple[TreeNode, Tuple[TreeNode, ...]]]:
+    stack = [(n, ()) for n in reversed(nodes)]
+    while stack:
+        node, chain = stack.pop()
+        yield node, chain
+        child_chain = chain + (node,)  # shared by all the children
+        stack.extend((c, child_chain) for c in reversed(node.children))
 
 
-def _breadth_first(nodes: List[TreeNode]) -> Iterator[Tuple[TreeNode, List[TreeNode]]]:
-    queue = [(n, []) for n in nodes]
+def _depth_first_with_prefix(nodes: List[TreeNode]) -> Iterator[Tuple[TreeNode, str]]:
+    """
+    depth first walk, along with the columns ("│" or " " per ancestor) to be drawn before each node
+    :return:
+    """
+    prefixes: Dict[int, str] = {}  # keyed by node id
+    for node, chain in _depth_first(nodes):
+        prefix = ""
+        if chain:  # extend the parent's columns instead of walking all the way up to the root
+            parent = chain[-1]
+            prefix = prefixes[id(parent)] + (" " if parent.is_last_sibling() else "│")
+        prefixes[id(node)] = prefix
+        yield node, prefix
+
+
+def _breadth_first(nodes: List[TreeNode]) -> Iterator[Tuple[TreeNode, Tuple[TreeNode, ...]]]:
+    queue = deque((n, ()) for n in nodes)
     while queue:
-        node, chain = queue.pop(0)
+        node, chain = queue.popleft()
         yield node, chain
-        for n in node.children:
-            queue.append((n, chain + [node]))
+        child_chain = chain + (node,)  # shared by all the children
+        queue.extend((c, child_chain) for c in node.children)
+
+
+@lru_cache(maxsize=None)
+def get_local_branches() -> Dict[str, str]:
+    """
+    SHAs of all the local branches in a single git call, rather than one call per branch
+    :return:
+    """
+    result: str = git("for-each-ref", "--format=%(refname) %(objectname)", "refs/heads/")
+    branches = {}
+    for line in result.splitlines():
+        ref, sha = line.split(" ", 1)
+        branches[ref[len("refs/heads/"):]] = sha
+    return branches
 
 
+@lru_cache(maxsize=None)
 def get_local_sha(branch_name: str) -> str:
-    result: str = git("rev-parse", branch_name)
+    local_branches = get_local_branches()
+    if branch_name in local_branches:
+        return local_branches[branch_name]
+    result: str = git("rev-parse", branch_name)  # not a local branch, e.g. a remote branch
     return result.strip()
 
 
@@ -617,12 +696,16 @@ def get_remotes() -> List[str]:
     return [r.strip() for r in results.split('\n') if len(r.strip()) > 0]
 
 
+@lru_cache(maxsize=None)
 def get_merge_base(branch1: str, branch2: str) -> str:
     result: str = git("merge-base", branch1, branch2)
     return result.strip()
 
 
+@lru_cache(maxsize=None)
 def local_branch_exists(branch_name: str) -> bool:
+    if branch_name in get_local_branches():
+        return True
     try:
         git("rev-parse", "--verify", branch_name)
         return True
@@ -630,25 +713,41 @@ def local_branch_exists(branch_name: str) -> bool:
         return False
 
 
+@lru_cache(maxsize=None)
 def get_commits(start: str, end: str) -> List[LocalCommit]:
-    return [LocalCommit(sha=commit)
-            for commit in
-            git("log", "--format=format:%H", "%s..%s" % (start, end)).strip().split()]
+    # the messages are read in the same call, separated with ASCII unit (\x1f) and record (\x1e) separators
+    result: str = git("log", "--format=%H%x1f%B%x1e", "%s..%s" % (start, end))
+    commits = []
+    for record in result.split("\x1e"):
+        if not record.strip():
+            continue
+        sha, message = record.split("\x1f", 1)
+        commits.append(LocalCommit(sha=sha.strip(), message=message.strip()))
+    return commits
+
+
+def clear_branch_caches():
+    """
+    the git lookups by branch name are memoized, the cached results are stale once a branch moves
+    :return:
+    """
+    for lookup in (get_local_branches, get_local_sha, get_merge_base, local_branch_exists, get_commits):
+        lookup.cache_clear()
 
 
 def filtered_rebase_start_commit(base_branch: str, node_branch: str) -> Optional[str]:
     merge_point = get_merge_base(base_branch, node_branch)
     base_commits = get_commits(merge_point, base_branch)
     child_commits = get_commits(merge_point, node_branch)
-    common_commit_indexes = []
-    for base, child in zip(reversed(base_commits), reversed(child_commits)):
+    # walk from the oldest commits up, the newest of the leading common commits is where the rebase starts
+    last_common_index: Optional[int] = None
+    for i, (base, child) in enumerate(zip(reversed(base_commits), reversed(child_commits))):
         if base.get_message() == child.get_message():
-            common_commit_indexes.append(child_commits.index(child))
+            last_common_index = len(child_commits) - 1 - i
         else:
             break
-    if common_commit_indexes:
-        common_commit_indexes = sorted(common_commit_indexes)
-        return child_commits[common_commit_indexes[0]].sha
+    if last_common_index is not None:
+        return child_commits[last_common_index].sha
     return None
 
 